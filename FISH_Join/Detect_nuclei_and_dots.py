@@ -6,25 +6,37 @@
 #@ Integer (label="Nucleus channel") nuclei_channel
 #@ String (label="Nuclei segmentation params",value="{}") _nuclei_params_override
 #@ String (label="QuPath executable") qupath_executable
+#@ Float (label="Nuclei polygon simplification tolerance (pixels, 0 to disable; small values can slow the join)",value=0.0) simplify_tolerance
 #@ Boolean (label="Segment dots",value=True) do_dots_segmentation
 #@ String (label="Dots channels (comma separated)") _dots_channel
 #@ String (label="Dots segmentation params (key per channel)",value="{}") _dots_params_override
 #@ File (label="Per-file parameters (csv)", required=false) _per_file_params
+#@ File (label="Output directory (empty for images directory)",style="directory",required=false) _output_directory
 #@ Boolean (label="Show results table when finished",value=True) show_results_table
+#@ Integer (label="Preview: images per sub directory (0 for a full run)",value=0) preview_sample_size
 import os
 import csv
 import json
 from glob import fnmatch
 import tempfile
 import itertools
+import random
+import shutil
+import subprocess
+import time
+from StringIO import StringIO
 
 from ij import IJ
+from ij.measure import ResultsTable
 
 import fish_join_modules.join as join
 from fish_join_modules.nuclei_segmentor import QuPathSegmentor
 from fish_join_modules.dots_segmentor import RSFISHSegmentor
-from fish_join_modules.output_filenames import global_join_filename, global_nuclei_filename, \
-        image_join_filename, image_nuclei_filename
+from fish_join_modules.output_filenames import image_join_filename, image_nuclei_filename, \
+        segment_join_filename, segment_nuclei_filename, segment_nuclei_info_filename
+from fish_join_modules.atomic import atomic_write
+from fish_join_modules.segments import merge_segments, prune_segments, remove_segment
+from fish_join_modules.nuclei_info import NUCLEI_INFO_HEADERS, nuclei_info_row
 from fish_join_modules.per_file_params import read_per_file_params
 
 
@@ -40,6 +52,10 @@ if _dots_params_override.strip():
 else:
     dots_params_override = {}
 per_file_params_filename = str(_per_file_params)
+if _output_directory:
+    output_directory = str(_output_directory)
+else:
+    output_directory = directory
 
 
 def create_file_list(directory, pattern, reuse=False):
@@ -58,57 +74,211 @@ def create_file_list(directory, pattern, reuse=False):
     return file_list_path
 
 
+def sample_file_list(file_list_path, sample_size, output_dir):
+    """
+    Draw a random sample of files from each sub directory in the file list, and write it
+    to a new file list in output_dir.
+
+    :param str file_list_path: Path to a list of files, as created by create_file_list()
+    :param int sample_size: Number of files to draw from each sub directory
+    :param str output_dir: Directory to write the sampled file list to
+    :return tuple: Path to the sampled file list, dict of the number of files in each sub directory
+    """
+    files_by_dir = {}
+    for file_path in open(file_list_path):
+        file_path = file_path.strip()
+        if not file_path:
+            continue
+        files_by_dir.setdefault(os.path.dirname(file_path), []).append(file_path)
+
+    sample_list_path = os.path.join(output_dir, 'fish_join_preview_file_list')
+    with open(sample_list_path, 'w') as sample_list:
+        for dir_path in sorted(files_by_dir):
+            dir_files = files_by_dir[dir_path]
+            for file_path in random.sample(dir_files, min(sample_size, len(dir_files))):
+                sample_list.write(file_path + '\n')
+
+    dir_counts = dict((dir_path, len(dir_files)) for dir_path, dir_files in files_by_dir.items())
+    return sample_list_path, dir_counts
+
+
 class BatchRunner:
-    image_join_headers = ['x', 'y', 't', 'c', 'intensity', 'nucleus_id', 'channel']
-    global_join_headers = image_join_headers + ['filename']
+    image_join_headers = join.IMAGE_JOIN_HEADERS
+    global_join_headers = join.GLOBAL_JOIN_HEADERS
 
-    def __init__(self, nuclei_segmentor, dots_segmentor, base_directory):
+    def __init__(self, nuclei_segmentor, dots_segmentor, base_directory, output_directory=None):
         self.nuclei_segmentor = nuclei_segmentor
         self.dots_segmentor = dots_segmentor
         self.base_dir = base_directory
+        self.output_dir = output_directory or base_directory
 
     def run(self, file_list, per_file_params={}):
-        global_join_path = global_join_filename(self.base_dir)
-        global_nuclei_path = global_nuclei_filename(self.base_dir)
+        """
+        Process all files in the list, then merge the results of all images in the output
+        directory into the global output files.
 
+        Each image's results are written to its own segment files under the output directory,
+        so separate runs (e.g. on different sub directories) can use the same output directory,
+        and an interrupted run leaves only complete segments. Segments of images under the base
+        directory that aren't in file_list are removed before merging. See also merge_segments().
+        """
         IJ.log("Starting dots processing")
-        with open(global_join_path, 'wb') as global_join_fd, open(global_nuclei_path, 'w') as global_nuclei:
-            global_join = csv.DictWriter(global_join_fd, fieldnames=self.global_join_headers, extrasaction='ignore' )
-            global_join.writeheader()
-            global_nuclei.write('[\n')
-            self._iterate_file_list(file_list, global_join, global_nuclei, per_file_params)
-            global_nuclei.write(']\n')
-        IJ.log("Finished processing all files")
-
-    def _iterate_file_list(self, file_list, global_join, global_nuclei, per_file_params={}):
-        for file_idx, file_path in enumerate(open(file_list)):
+        file_paths = []
+        for file_path in open(file_list):
             file_path = file_path.strip()
-            file_params = per_file_params.get(file_path, {})
+            if not file_path:
+                continue
+            self.process_file(file_path, per_file_params.get(file_path, {}))
+            file_paths.append(file_path)
+        pruned = prune_segments(self.output_dir, self.base_dir, file_paths)
+        if pruned:
+            IJ.log("Removed results of {} files that are no longer in the file list".format(pruned))
+        IJ.log("Merging results")
+        merged = merge_segments(self.output_dir)
+        IJ.log("Finished processing all files, merged results of {} files".format(merged))
+
+    def process_file(self, file_path, file_params={}):
+        """
+        Segment dots in a single file, join them with the file's nuclei and write the per-image
+        outputs and segment files. Each file is written atomically.
+
+        :return int: Number of dots
+        """
+        nuclei = self.nuclei_segmentor.get_image_nuclei(file_path)
+        dots_filenames = self.dots_segmentor.process_image(file_path, file_params)
+        # Join before writing anything, so a failure can't leave new nuclei next to old dots
+        dots = self._join_dots(dots_filenames, nuclei, file_path)
+
+        # Drop the previous run's dots before replacing the nuclei, so an interruption below
+        # leaves an incomplete segment rather than new nuclei paired with old dots
+        remove_segment(self.output_dir, file_path)
+        if os.path.exists(image_join_filename(file_path)):
+            os.remove(image_join_filename(file_path))
+        with atomic_write(image_nuclei_filename(file_path)) as image_nuclei, \
+                atomic_write(segment_nuclei_filename(self.output_dir, file_path)) as segment_nuclei, \
+                atomic_write(segment_nuclei_info_filename(self.output_dir, file_path), 'wb') as segment_nuclei_info:
+            self._write_nuclei(nuclei, image_nuclei, segment_nuclei, segment_nuclei_info, file_path)
+
+        # The segment join file is written last, as it marks the image's segment as complete
+        with atomic_write(image_join_filename(file_path), 'wb') as image_join, \
+                atomic_write(segment_join_filename(self.output_dir, file_path), 'wb') as segment_join:
+            return self._write_join(dots, image_join, segment_join)
+
+    def preview(self, sample_list, dir_counts, per_file_nuclei_params={}, per_file_dots_params={},
+                segment_nuclei=True, segment_dots=True):
+        """
+        Run nuclei and dots segmentation on a sample of the files, show per-image counts and
+        throughput and project the time and output size of a full run on all files in dir_counts.
+
+        Segmentation results are written wherever the segmentors are configured to write them, so
+        point them to a temporary directory to keep existing results intact (see main()). The joined
+        outputs are only written to memory.
+
+        :param str sample_list: Path to a list of sampled files, see sample_file_list()
+        :param dict dir_counts: Number of files in each sub directory in the full run
+        :param dict per_file_nuclei_params: Per-file QuPath param overrides
+        :param dict per_file_dots_params: Per-file RS-FISH param overrides
+        :param bool segment_nuclei: Run QuPath on the sample. If False, existing QuPath results are used.
+        :param bool segment_dots: Run RS-FISH on the sample. If False, spots are not counted.
+        """
+        sample_files = [ f.strip() for f in open(sample_list) if f.strip() ]
+        if not sample_files:
+            IJ.log("Preview: no files in sample")
+            return
+        sampled_counts = {}
+        for file_path in sample_files:
+            dir_path = os.path.dirname(file_path)
+            sampled_counts[dir_path] = sampled_counts.get(dir_path, 0) + 1
+
+        nuclei_seconds, nuclei_overhead_seconds = 0.0, 0.0
+        if segment_nuclei:
+            # A full run also starts QuPath once, measure that fixed cost so it isn't scaled with the file count
+            empty_list = os.path.join(os.path.dirname(sample_list), 'fish_join_empty_file_list')
+            open(empty_list, 'w').close()
+            start = time.time()
+            try:
+                self.nuclei_segmentor.process_file_list(empty_list)
+                nuclei_overhead_seconds = time.time() - start
+            except subprocess.CalledProcessError:
+                IJ.log("Preview: couldn't measure QuPath startup time, projection will include it per file")
+            start = time.time()
+            self.nuclei_segmentor.process_file_list(sample_list, per_file_nuclei_params)
+            nuclei_seconds = max(time.time() - start - nuclei_overhead_seconds, 0.0)
+
+        rt = ResultsTable()
+        n_nuclei, n_spots, spots_seconds = 0, 0, 0.0
+        projected_nuclei, projected_spots, projected_bytes = 0.0, 0.0, 0.0
+        for file_path in sample_files:
+            dir_path = os.path.dirname(file_path)
+            # Each sampled file stands for all unsampled files in its sub directory
+            weight = float(dir_counts[dir_path]) / sampled_counts[dir_path]
+            file_params = per_file_dots_params.get(file_path, {})
             nuclei = self.nuclei_segmentor.get_image_nuclei(file_path)
-            dots_filenames = self.dots_segmentor.process_image(file_path, file_params)
+            start = time.time()
+            if segment_dots:
+                dots_filenames = self.dots_segmentor.process_image(file_path, file_params)
+            else:
+                dots_filenames = []
+            # Write outputs to memory, to measure their size without touching existing results
+            image_nuclei, segment_nuclei, segment_nuclei_info = StringIO(), StringIO(), StringIO()
+            image_join, segment_join = StringIO(), StringIO()
+            self._write_nuclei(nuclei, image_nuclei, segment_nuclei, segment_nuclei_info, file_path)
+            file_spots = self._write_join(self._join_dots(dots_filenames, nuclei, file_path), image_join, segment_join)
+            file_seconds = time.time() - start
+            # Merged global files are about the same size as the segments
+            file_bytes = 2 * sum(len(f.getvalue()) for f in [segment_nuclei, segment_nuclei_info, segment_join])
+            file_bytes += sum(len(f.getvalue()) for f in [image_nuclei, image_join])
 
-            with open(image_nuclei_filename(file_path), 'w') as image_nuclei:
-                self._write_nuclei(nuclei, global_nuclei, image_nuclei, file_path, file_idx == 0)
+            n_nuclei += len(nuclei)
+            n_spots += file_spots
+            spots_seconds += file_seconds
+            projected_nuclei += weight * len(nuclei)
+            projected_spots += weight * file_spots
+            projected_bytes += weight * file_bytes
+            rt.addRow()
+            rt.addValue('filename', file_path)
+            rt.addValue('nuclei', len(nuclei))
+            rt.addValue('spots', file_spots)
+            rt.addValue('dots_and_join_seconds', file_seconds)
+            rt.addValue('output_bytes', file_bytes)
+        rt.show('Preview')
 
-            with open(image_join_filename(file_path), 'wb') as image_join:
-                self._write_join(self.dots_segmentor.channels, dots_filenames, nuclei, image_join, global_join, file_path)
+        total_files = sum(dir_counts.values())
+        file_scale = float(total_files) / len(sample_files)
+        IJ.log("Preview: {} of {} files, {} nuclei, {} spots".format(len(sample_files), total_files, n_nuclei, n_spots))
+        projected_seconds = nuclei_overhead_seconds
+        if n_nuclei and nuclei_seconds > 0:
+            nuclei_rate = n_nuclei / nuclei_seconds
+            IJ.log("Preview: nuclei segmentation: {:.1f} nuclei/sec".format(nuclei_rate))
+            projected_seconds += projected_nuclei / nuclei_rate
+        else:
+            projected_seconds += nuclei_seconds * file_scale
+        if n_spots and spots_seconds > 0:
+            spots_rate = n_spots / spots_seconds
+            IJ.log("Preview: dots segmentation and join: {:.1f} spots/sec".format(spots_rate))
+            projected_seconds += projected_spots / spots_rate
+        else:
+            projected_seconds += spots_seconds * file_scale
+        IJ.log("Preview: projected full run: {:.0f} nuclei, {:.0f} spots, {:.1f} minutes, {:.1f} MB of outputs".format(
+            projected_nuclei, projected_spots, projected_seconds / 60, projected_bytes / 1024 / 1024))
 
-    def _write_nuclei(self, nuclei, global_nuclei, image_nuclei, file_path, is_first_file):
+    def _write_nuclei(self, nuclei, image_nuclei, segment_nuclei, segment_nuclei_info_fd, file_path):
+        segment_nuclei_info = csv.DictWriter(segment_nuclei_info_fd, fieldnames=NUCLEI_INFO_HEADERS)
+        segment_nuclei_info.writeheader()
         image_nuclei.write('[\n')
         for idx, n in enumerate(nuclei):
+            # The exact polygon of simplified nuclei is only needed for joining
+            n = dict((k, v) for k, v in n.items() if k not in ('exact_polygon', 'tolerance', 'bbox'))
             if idx == 0:
                 image_nuclei.write(json.dumps(n))
             else:
                 image_nuclei.write(',' + json.dumps(n))
             n['filename'] = file_path
-            if idx == 0 and is_first_file:
-                global_nuclei.write(json.dumps(n))
-            else:
-                global_nuclei.write(',' + json.dumps(n))
+            segment_nuclei.write(json.dumps(n) + '\n')
+            segment_nuclei_info.writerow(nuclei_info_row(n))
         image_nuclei.write(']\n')
 
-    def _write_join(self, channels, filenames, nuclei, image_join, global_join, file_path, sort=True):
-        image_join_output = csv.DictWriter(image_join, extrasaction='ignore', fieldnames=self.image_join_headers)
+    def _join_dots(self, filenames, nuclei, file_path, sort=True):
         csv_out = []
         for ch, csv_file in zip(self.dots_segmentor.channels, filenames):
             new_csv = join.join_from_csv(nuclei, csv_file, dict(channel=ch, filename=file_path))
@@ -118,9 +288,20 @@ class BatchRunner:
         if sort:
             # null nucleus check is used to put all null nuclei at the bottom
             csv_out = sorted(csv_out, key=lambda d: (d['nucleus_id'] is None, d['nucleus_id'], d['channel']))
+        else:
+            csv_out = list(csv_out)
+
+        return csv_out
+
+    def _write_join(self, dots, image_join, segment_join_fd):
+        image_join_output = csv.DictWriter(image_join, extrasaction='ignore', fieldnames=self.image_join_headers)
+        segment_join = csv.DictWriter(segment_join_fd, extrasaction='ignore', fieldnames=self.global_join_headers)
         image_join_output.writeheader()
-        image_join_output.writerows(csv_out)
-        global_join.writerows(csv_out)
+        image_join_output.writerows(dots)
+        segment_join.writeheader()
+        segment_join.writerows(dots)
+
+        return len(dots)
 
 
 def main():
@@ -133,15 +314,31 @@ def main():
         units = 'pixels'
     else:
         units = 'microns'
-    nuclei_segmentor = QuPathSegmentor(nuclei_channel, qupath_executable, tmp_dir, units=units, params_override=nuclei_params_override)
+    nuclei_segmentor = QuPathSegmentor(nuclei_channel, qupath_executable, tmp_dir, units=units,
+                                       params_override=nuclei_params_override, simplify_tolerance=simplify_tolerance)
+    dots_segmentor = RSFISHSegmentor(channels=dots_channels, params_override=dots_params_override)
+    batch_runner = BatchRunner(nuclei_segmentor, dots_segmentor, directory, output_directory)
+    if preview_sample_size > 0:
+        # Keep preview segmentation results away from the images, so they don't replace results of a full run
+        preview_dir = tempfile.mkdtemp(prefix='fish_join_preview_', dir=tmp_dir)
+        try:
+            if do_nuclei_segmentation:
+                nuclei_segmentor.output_dir = preview_dir
+            pattern_dir = preview_dir.replace('{', '{{').replace('}', '}}')
+            dots_segmentor.result_file_pattern = os.path.join(pattern_dir, '{image_title}_C{channel}.csv')
+            sample_list, dir_counts = sample_file_list(file_list, preview_sample_size, preview_dir)
+            IJ.log("Running preview on a sample of {} files per sub directory".format(preview_sample_size))
+            batch_runner.preview(sample_list, dir_counts, per_file_nuclei_params, per_file_dots_params,
+                                 segment_nuclei=do_nuclei_segmentation, segment_dots=do_dots_segmentation)
+        finally:
+            shutil.rmtree(preview_dir)
+        return
     if do_nuclei_segmentation:
         nuclei_segmentor.process_file_list(file_list, per_file_nuclei_params)
-    dots_segmentor = RSFISHSegmentor(channels=dots_channels, params_override=dots_params_override)
-    batch_runner = BatchRunner(nuclei_segmentor, dots_segmentor, directory)
     if do_dots_segmentation:
         batch_runner.run(file_list, per_file_dots_params)
     if show_results_table:
-        IJ.run("Show results for all files", "directory=[{}]".format(directory))
+        IJ.run("Show results for all files", "directory=[{}]".format(output_directory))
 
 
 if __name__ in ['__builtin__','__main__']:
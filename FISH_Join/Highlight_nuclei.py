@@ -2,6 +2,7 @@
 #@ String (label="Nuclei ids, comma separated (-1 for all)") nucleui_ids
 #@ Boolean (label="Populate ROI with dots") populate_roi
 import json
+import jarray
 from ij import IJ, ImagePlus, WindowManager
 from ij.gui import Overlay, Roi, PolygonRoi, PointRoi
 from ij.plugin.frame import RoiManager
@@ -37,18 +38,27 @@ def annotate(image=None, nucleus_id=None, populate_roi=True):
     else:
         if isinstance(nucleus_id, int):
             nucleus_id = [nucleus_id]
-        chosen_nuclei = [ n for n in nuclei if n['id'] in nucleus_id or -1 in nucleus_id ]
+        nucleus_id = set(nucleus_id)
+        if -1 in nucleus_id:
+            chosen_nuclei = nuclei
+        else:
+            chosen_nuclei = [ n for n in nuclei if n['id'] in nucleus_id ]
 
-    overlay = None
+    overlay = Overlay()
     for nucleus in chosen_nuclei:
-        overlay = add_polygon_overlay(imp, nucleus['polygon'], nucleus['id'], overlay)
+        add_polygon_overlay(imp, nucleus['polygon'], nucleus['id'], overlay)
+    imp.setOverlay(overlay)
 
     if populate_roi:
         add_dots_roi(image_path, [n['id'] for n in chosen_nuclei])
+    imp.show()
 
 def add_polygon_overlay(imp, polygon_edges, label=None, overlay=None):
     """
     Adds a polygon overlay with a label to the specified ImagePlus.
+
+    The image isn't shown. When adding many polygons, create the overlay once,
+    pass it to each call and show the image at the end.
     
     :param imp: The ImagePlus object to which the overlay will be added.
     :param polygon_edges: List of (x, y) coordinates representing the polygon's edges.
@@ -57,20 +67,19 @@ def add_polygon_overlay(imp, polygon_edges, label=None, overlay=None):
 
     :return: Overlay object
     """
+    n_points = len(polygon_edges)
+    x_points = jarray.zeros(n_points, 'f')
+    y_points = jarray.zeros(n_points, 'f')
+    for i, (x, y) in enumerate(polygon_edges):
+        x_points[i] = x
+        y_points[i] = y
     
-    x_points = []
-    y_points = []
-    for x, y in polygon_edges:
-        x_points.append(x)
-        y_points.append(y)
-    
-    polygon_roi = PolygonRoi(x_points, y_points, Roi.POLYGON)
-    if label:
+    polygon_roi = PolygonRoi(x_points, y_points, n_points, Roi.POLYGON)
+    if label is not None:
         polygon_roi.setName(str(label))
     if overlay is None:
         overlay = Overlay()
         imp.setOverlay(overlay)
-        imp.show()
         
     overlay.add(polygon_roi)
 
@@ -78,7 +87,8 @@ def add_polygon_overlay(imp, polygon_edges, label=None, overlay=None):
     
 def add_dots_roi(image_path, chosen_nuclei):
     """
-    Add the dots inside the given nuclei to the current image's ROI
+    Add the dots inside the given nuclei to the current image's ROI. Dots are added
+    as a single multi-point ROI per nucleus and channel, named {nucleus}_C{channel}.
 
     :param image_path: Path to current image, used to find the dots-nuclei CSV file
     :param chosen_nuclei: List of nuclei IDs
@@ -90,7 +100,10 @@ def add_dots_roi(image_path, chosen_nuclei):
     if roi_manager is None:
         roi_manager = RoiManager()
         roi_manager.setVisible(True)
+    chosen_nuclei = set(chosen_nuclei)
     dots_path = output_filenames.image_join_filename(image_path)
+    # (nucleus, channel) -> ([x, ...], [y, ...])
+    points = {}
     with open(dots_path, 'rb') as dots:
         for dot in csv.DictReader(dots):
             try:
@@ -99,12 +112,15 @@ def add_dots_roi(image_path, chosen_nuclei):
                 # We don't care about dots that don't fit to any nucleus
                 continue
             if n in chosen_nuclei:
-                x = float(dot['x'])
-                y = float(dot['y'])
                 c = int(dot['channel'])
-                roi = PointRoi(x, y)
-                roi.setName('{x}_{y}_{c}_{n}'.format(x=x, y=y, c=c, n=n))
-                roi_manager.addRoi(roi)
+                x_points, y_points = points.setdefault((n, c), ([], []))
+                x_points.append(float(dot['x']))
+                y_points.append(float(dot['y']))
+
+    for (n, c), (x_points, y_points) in sorted(points.items()):
+        roi = PointRoi(jarray.array(x_points, 'f'), jarray.array(y_points, 'f'), len(x_points))
+        roi.setName('{n}_C{c}'.format(n=n, c=c))
+        roi_manager.addRoi(roi)
 
 def _get_imp_file_path(imp):
     file_info = imp.getOriginalFileInfo()
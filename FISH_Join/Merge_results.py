@@ -0,0 +1,14 @@
+#@ File (label="Output directory",style="directory") directory
+
+from ij import IJ
+
+from fish_join_modules.segments import merge_segments
+
+def main():
+    # Merges the results of all runs that used this output directory. To reset it, delete its fish_join_segments directory
+    IJ.log("Merging results in {}".format(directory))
+    merged = merge_segments(str(directory))
+    IJ.log("Merged results of {} files".format(merged))
+
+if __name__ in ['__builtin__', '__main__']:
+    main()
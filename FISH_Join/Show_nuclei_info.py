@@ -1,24 +1,49 @@
 #@ File (style="directory") directory
+#@ String (label="Filename pattern, e.g. img*.tif or */dir/*.tif (empty for all files)",value="",required=false) filename_pattern
+#@ Float (label="Min area (0 for no minimum)",value=0.0) min_area
+#@ Float (label="Max area (0 for no maximum)",value=0.0) max_area
+#@ Integer (label="Page size (0 for all nuclei)",value=0) page_size
+#@ Integer (label="Page (one-based)",value=1) page
 
-import json
+import os
+import csv
+import tempfile
 
 from ij import IJ
 from ij.measure import ResultsTable
 
-from fish_join_modules.output_filenames import global_nuclei_filename
+from fish_join_modules.output_filenames import global_nuclei_filename, global_nuclei_info_filename
+from fish_join_modules.nuclei_info import NUCLEI_INFO_HEADERS, is_nuclei_info_stale, read_nuclei_info, \
+        write_nuclei_info_from_json
 
 def main():
     global_nuclei_path = global_nuclei_filename(str(directory))
-    nuclei = json.load(open(global_nuclei_path))
-    rt = ResultsTable()
-    for n in nuclei:
-        IJ.log(repr(n))
-        rt.addRow()
-        rt.addValue('filename', n['filename'])
-        rt.addValue('id', n['id'])
-        rt.addValue('centroid_x', n['centroid'][0])
-        rt.addValue('centroid_y', n['centroid'][1])
-        rt.addValue('area', n['area'])
+    global_nuclei_info_path = global_nuclei_info_filename(str(directory))
+    if is_nuclei_info_stale(global_nuclei_path, global_nuclei_info_path):
+        IJ.log("Show nuclei info: nuclei info file is missing or outdated, creating it from {}".format(global_nuclei_path))
+        write_nuclei_info_from_json(global_nuclei_path, global_nuclei_info_path)
+
+    if not (filename_pattern or min_area or max_area or page_size):
+        # Nothing to filter, let ImageJ load the whole table directly
+        rt = ResultsTable.open(global_nuclei_info_path)
+    else:
+        if page_size:
+            offset, limit = (max(page, 1) - 1) * page_size, page_size
+        else:
+            offset, limit = 0, None
+        rows = read_nuclei_info(global_nuclei_info_path, filename_pattern or None,
+                                min_area or None, max_area or None, offset, limit)
+        IJ.log("Show nuclei info: showing {} nuclei".format(len(rows)))
+        # Loading a CSV into a ResultsTable is much faster than adding rows one by one
+        fd, page_path = tempfile.mkstemp(suffix='.csv')
+        try:
+            with os.fdopen(fd, 'wb') as page_fd:
+                page_csv = csv.DictWriter(page_fd, fieldnames=NUCLEI_INFO_HEADERS)
+                page_csv.writeheader()
+                page_csv.writerows(rows)
+            rt = ResultsTable.open(page_path)
+        finally:
+            os.remove(page_path)
     rt.show('Nuclei info')
 
 if __name__ in ['__builtin__', '__main__']:
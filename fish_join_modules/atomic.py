@@ -0,0 +1,39 @@
+import os
+import uuid
+from contextlib import contextmanager
+
+from java.nio.file import Files, Paths, StandardCopyOption
+
+
+@contextmanager
+def atomic_write(path, mode='w'):
+    """
+    Open a temporary file next to path for writing, and rename it to path once the
+    block finishes successfully, replacing any existing file atomically. Readers never
+    see a partially written file.
+
+    :param str path: Path of the final file. Missing parent directories are created.
+    :param str mode: File mode, 'w' or 'wb'
+    """
+    dir_path = os.path.dirname(path)
+    if dir_path and not os.path.isdir(dir_path):
+        try:
+            os.makedirs(dir_path)
+        except OSError:
+            # Another process may have created it in the meantime
+            if not os.path.isdir(dir_path):
+                raise
+    tmp_path = '{}.{}.tmp'.format(path, uuid.uuid4().hex)
+    fd = open(tmp_path, mode)
+    try:
+        yield fd
+        fd.close()
+        _replace(tmp_path, path)
+    except:
+        fd.close()
+        os.remove(tmp_path)
+        raise
+
+def _replace(src, dst):
+    # os.rename can't replace an existing file on Windows, and remove-then-rename isn't atomic
+    Files.move(Paths.get(src), Paths.get(dst), StandardCopyOption.REPLACE_EXISTING, StandardCopyOption.ATOMIC_MOVE)
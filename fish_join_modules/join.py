@@ -1,6 +1,8 @@
 import csv
 import json
 
+IMAGE_JOIN_HEADERS = ['x', 'y', 't', 'c', 'intensity', 'nucleus_id', 'channel']
+GLOBAL_JOIN_HEADERS = IMAGE_JOIN_HEADERS + ['filename']
 
 def join_from_csv(nuclei, csv_filename, additional_fields={}):
     """
@@ -25,7 +27,7 @@ def find_matching_nuclei(nuclei, dot):
     coords = dot['coords']
 
     for n in nuclei:
-        if _is_point_inside_polygon(n['polygon'], coords):
+        if _is_point_inside_nucleus(n, coords):
             return n['id']
     return None
 
@@ -41,6 +43,55 @@ def prepare_dots_csv(csv_dict):
 
     return sorted(dots, key=lambda d: d['coords'][1])
 
+def _is_point_inside_nucleus(nucleus, point):
+    """
+    Detect if a dot is inside the given nucleus. If the nucleus polygon was simplified (see
+    QuPathSegmentor's simplify_tolerance), dots within tolerance of the simplified boundary
+    are re-checked against the exact polygon, so the result is the same as for the exact one.
+    """
+    # Most nuclei are far away from the dot, reject them before scanning their edges
+    if 'bbox' in nucleus:
+        x, y = point
+        min_x, min_y, max_x, max_y = nucleus['bbox']
+        if x < min_x or x > max_x or y < min_y or y > max_y:
+            return False
+
+    polygon = nucleus['polygon']
+    exact_polygon = nucleus.get('exact_polygon')
+    if exact_polygon is not None and is_point_near_polygon_boundary(polygon, point, nucleus['tolerance']):
+        return _is_point_inside_polygon(exact_polygon, point)
+    return _is_point_inside_polygon(polygon, point)
+
+def is_point_near_polygon_boundary(polygon, point, tolerance):
+    """
+    Return True if the point is at most tolerance away from one of the polygon's edges
+    """
+    n = len(polygon)
+    tolerance_sq = tolerance * tolerance
+    for i in range(n):
+        if point_segment_distance_sq(point, polygon[i], polygon[(i + 1) % n]) <= tolerance_sq:
+            return True
+    return False
+
+def point_segment_distance_sq(point, start, end):
+    """
+    Return the squared distance between a point and the line segment from start to end
+    """
+    x, y = point
+    x1, y1 = start
+    x2, y2 = end
+    dx = x2 - x1
+    dy = y2 - y1
+    length_sq = dx * dx + dy * dy
+    if length_sq == 0:
+        t = 0.0
+    else:
+        t = ((x - x1) * dx + (y - y1) * dy) / float(length_sq)
+        t = max(0.0, min(1.0, t))
+    px = x1 + t * dx - x
+    py = y1 + t * dy - y
+    return px * px + py * py
+
 def _is_point_inside_polygon(polygon, point):
     """
     Detect if a dot is inside the given polygon using the Ray Tracing algorithm.
@@ -0,0 +1,79 @@
+import csv
+import json
+import os
+from glob import fnmatch
+
+from fish_join_modules.atomic import atomic_write
+
+NUCLEI_INFO_HEADERS = ['filename', 'id', 'centroid_x', 'centroid_y', 'area']
+
+
+def nuclei_info_row(nucleus):
+    """
+    Return the scalar fields of a nucleus (which must have a 'filename' key) as a
+    dict matching NUCLEI_INFO_HEADERS.
+    """
+    return dict(filename=nucleus['filename'], id=nucleus['id'],
+                centroid_x=nucleus['centroid'][0], centroid_y=nucleus['centroid'][1],
+                area=nucleus['area'])
+
+def write_nuclei_info_from_json(nuclei_json_path, nuclei_info_path):
+    """
+    Create a nuclei info CSV from a global nuclei json file. Used for results that were
+    created before the info file was written alongside the nuclei json.
+    """
+    nuclei = json.load(open(nuclei_json_path))
+    with atomic_write(nuclei_info_path, 'wb') as info_fd:
+        info = csv.DictWriter(info_fd, fieldnames=NUCLEI_INFO_HEADERS)
+        info.writeheader()
+        info.writerows(nuclei_info_row(n) for n in nuclei)
+
+def is_nuclei_info_stale(nuclei_json_path, nuclei_info_path):
+    """
+    Return True if the nuclei info CSV is missing or older than the global nuclei json
+    """
+    if not os.path.exists(nuclei_info_path):
+        return True
+    if not os.path.exists(nuclei_json_path):
+        return False
+    return os.path.getmtime(nuclei_json_path) > os.path.getmtime(nuclei_info_path)
+
+def read_nuclei_info(nuclei_info_path, filename_pattern=None, min_area=None, max_area=None, offset=0, limit=None):
+    """
+    Read rows from a nuclei info CSV, without parsing the numeric fields except where filtering needs them.
+
+    :param str nuclei_info_path: Path to nuclei info CSV
+    :param str filename_pattern: Optional glob pattern for the image file name. Matched against the
+                                 full image path if it contains a path separator.
+    :param float min_area: Optional minimal nucleus area
+    :param float max_area: Optional maximal nucleus area
+    :param int offset: Number of matching rows to skip, for paging
+    :param int limit: Max number of rows to return, or None for all
+    :return list[dict]: Matching rows
+    """
+    rows = []
+    matched = 0
+    match_full_path = filename_pattern and ('/' in filename_pattern or os.path.sep in filename_pattern)
+    with open(nuclei_info_path, 'rb') as info_fd:
+        for row in csv.DictReader(info_fd):
+            if filename_pattern:
+                if match_full_path:
+                    filename = row['filename']
+                else:
+                    filename = os.path.basename(row['filename'])
+                if not fnmatch.fnmatch(filename, filename_pattern):
+                    continue
+            if min_area is not None or max_area is not None:
+                area = float(row['area'])
+                if min_area is not None and area < min_area:
+                    continue
+                if max_area is not None and area > max_area:
+                    continue
+            matched += 1
+            if matched <= offset:
+                continue
+            rows.append(row)
+            if limit is not None and len(rows) >= limit:
+                break
+
+    return rows
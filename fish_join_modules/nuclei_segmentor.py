@@ -5,6 +5,8 @@ import subprocess
 
 from ij import IJ
 
+from fish_join_modules.join import point_segment_distance_sq
+
 SCRIPT_DIR = os.path.dirname(__file__)
 
 class QuPathSegmentor:
@@ -40,7 +42,8 @@ class QuPathSegmentor:
                        "smoothBoundaries": True,
                        "makeMeasurements": True }
 
-    def __init__(self, channel, qupath_executable='QuPath', tmp_dir='/tmp', keep_project_dir=False, units='microns', params_override={}):
+    def __init__(self, channel, qupath_executable='QuPath', tmp_dir='/tmp', keep_project_dir=False, units='microns', params_override={},
+                 simplify_tolerance=0.0, output_dir=None):
         """
         :param int channel: Image channel that contains nuclei information
         :param str qupath_executable: Location of the QuPath command
@@ -48,12 +51,18 @@ class QuPathSegmentor:
         :param bool keep_project_dir: Whether to keep the project dir after run is finished or delete it
         :param str units: Which units the params have. Can be microns or pixels.
         :param dict params_override: Dictionary of parameters overrides to QuPath. See also default_params()
+        :param float simplify_tolerance: Max distance in pixels between a nucleus polygon and its simplified
+                                         version. 0 disables simplification.
+        :param str output_dir: Directory to write QuPath's geojson files to, mirroring the images' paths.
+                               If None, they are written next to the images.
         """
         self.channel = channel
         self.qupath_executable = qupath_executable
         self.tmp_dir = tmp_dir
         self._qupath_project_filename = 'project.qpproj'
         self.keep_project_dir = keep_project_dir
+        self.simplify_tolerance = simplify_tolerance
+        self.output_dir = output_dir
 
         if units == 'microns':
             params = self._default_params_microns.copy()
@@ -92,21 +101,36 @@ class QuPathSegmentor:
         """
         Run QuPath on a list of files.
 
-        Raw results will be written to a geojson file according to the format {image_path}_nuclei.geojson. 
-        Use get_image_nuclei() to parse these files.
+        Raw results will be written to a geojson file according to the format {image_path}_nuclei.geojson,
+        under output_dir if it was given. Use get_image_nuclei() to parse these files.
 
         :param str file_list_path: Path to a list of files, one path per line
         :param dict per_file_params: Per-file param overrides
         """
         qupath_project = os.path.join(self.tmp_dir, 'qupath')
-        IJ.log("QuPathSegmentor: creating QuPath project")
-        self.qupath_script('qupath_create_project.groovy', args=[file_list_path, qupath_project])
-        IJ.log("QuPathSegmentor: detecting nuclei")
         per_file_params_json = json.dumps(per_file_params)
-        self.qupath_script( 'qupath_get_nuclei.groovy', args=[self.params_json, per_file_params_json], project=qupath_project)
-        if not self.keep_project_dir:
-            IJ.log("QuPathSegmentor: cleaning up QuPath project")
-            shutil.rmtree(qupath_project)
+        output_filenames = {}
+        if self.output_dir is not None:
+            for image_path in open(file_list_path):
+                image_path = image_path.strip()
+                if not image_path:
+                    continue
+                output_filename = self._get_output_filename(image_path)
+                if not os.path.isdir(os.path.dirname(output_filename)):
+                    os.makedirs(os.path.dirname(output_filename))
+                # The script normalizes QuPath's image paths the same way before looking them up
+                output_filenames[os.path.normpath(os.path.abspath(image_path))] = output_filename
+        output_filenames_json = json.dumps(output_filenames)
+        try:
+            IJ.log("QuPathSegmentor: creating QuPath project")
+            self.qupath_script('qupath_create_project.groovy', args=[file_list_path, qupath_project])
+            IJ.log("QuPathSegmentor: detecting nuclei")
+            self.qupath_script( 'qupath_get_nuclei.groovy', args=[self.params_json, per_file_params_json, output_filenames_json],
+                               project=qupath_project)
+        finally:
+            if not self.keep_project_dir and os.path.isdir(qupath_project):
+                IJ.log("QuPathSegmentor: cleaning up QuPath project")
+                shutil.rmtree(qupath_project)
         IJ.log("QuPathSegmentor: done")
 
     def get_image_nuclei(self, image_path):
@@ -133,6 +157,11 @@ class QuPathSegmentor:
         Parse QuPath's geojson file and return a list of dicts with
         each nucleus' ID and polygon vertices.
 
+        Each nucleus also has a 'bbox' of its exact polygon, grown by simplify_tolerance.
+        If simplify_tolerance is set, 'polygon' holds the simplified polygon, and the
+        original one is kept under 'exact_polygon' along with the 'tolerance' used.
+        These keys are only meant for joining and are not written to output files.
+
         :param geojson: either a path to a filename, an open geojson file
                         or a parsed geojson as a dict object.
         :return list[dicts]:
@@ -156,8 +185,16 @@ class QuPathSegmentor:
                 polygon = feature['nucleusGeometry']['coordinates'][0]
                 centroid = calc_centroid(polygon)
                 area = feature["properties"]['measurements']['Nucleus: Area']
-                nuclei.append(dict(id=index, polygon=polygon,
-                                   centroid=centroid, area=area))
+                nucleus = dict(id=index, polygon=polygon,
+                               centroid=centroid, area=area,
+                               bbox=calc_bbox(polygon, self.simplify_tolerance))
+                if self.simplify_tolerance > 0:
+                    simplified = simplify_polygon(polygon, self.simplify_tolerance)
+                    if len(simplified) < len(polygon):
+                        nucleus['polygon'] = simplified
+                        nucleus['exact_polygon'] = polygon
+                        nucleus['tolerance'] = self.simplify_tolerance
+                nuclei.append(nucleus)
             except (KeyError, IndexError):
                 IJ.log("parse_nuclei_geojson: nuclei {} is bad, skipping".format(index))
                 continue
@@ -168,6 +205,8 @@ class QuPathSegmentor:
 
     def _get_output_filename(self, image_file_path):
         filename = os.path.splitext(image_file_path)[0]
+        if self.output_dir is not None:
+            filename = os.path.join(self.output_dir, os.path.splitdrive(os.path.abspath(filename))[1].lstrip(os.path.sep))
 
         return filename + '_nuclei.geojson'
 
@@ -187,3 +226,46 @@ def calc_centroid(vertices):
     x /= 6 * signed_area
     y /= 6 * signed_area
     return x, y
+
+def calc_bbox(vertices, margin=0):
+    """
+    Return the bounding box of the vertices as (min_x, min_y, max_x, max_y), grown by margin on each side
+    """
+    xs = [ v[0] for v in vertices ]
+    ys = [ v[1] for v in vertices ]
+    return min(xs) - margin, min(ys) - margin, max(xs) + margin, max(ys) + margin
+
+def simplify_polygon(vertices, tolerance):
+    """
+    Simplify a polygon using the Douglas-Peucker algorithm. Every vertex of the original
+    polygon is at most tolerance away from the simplified one.
+
+    :param list vertices: x-y pairs. QuPath polygons are closed, i.e. the last vertex equals the first one.
+    :param float tolerance: Max allowed distance, in pixels
+    :return list: The kept vertices, in their original order
+    """
+    n = len(vertices)
+    if n < 4:
+        return vertices
+    keep = [False] * n
+    keep[0] = keep[n - 1] = True
+    # Iterative to avoid hitting the recursion limit on large polygons
+    tolerance_sq = tolerance * tolerance
+    stack = [(0, n - 1)]
+    while stack:
+        start, end = stack.pop()
+        max_dist, max_idx = 0.0, None
+        for i in range(start + 1, end):
+            dist = point_segment_distance_sq(vertices[i], vertices[start], vertices[end])
+            if dist > max_dist:
+                max_dist, max_idx = dist, i
+        if max_idx is not None and max_dist > tolerance_sq:
+            keep[max_idx] = True
+            stack.append((start, max_idx))
+            stack.append((max_idx, end))
+
+    simplified = [ v for v, k in zip(vertices, keep) if k ]
+    if len(simplified) < 4:
+        # Too few vertices left for a polygon
+        return vertices
+    return simplified
@@ -1,5 +1,9 @@
 import os
 
+SEGMENT_JOIN_SUFFIX = '_nuclei_dots_joined.csv'
+SEGMENT_NUCLEI_SUFFIX = '_nuclei.jsonl'
+SEGMENT_NUCLEI_INFO_SUFFIX = '_nuclei_info.csv'
+
 def image_join_filename(image_path):
     no_ext_path = os.path.splitext(image_path)[0]
     return no_ext_path + '_nuclei_dots_joined.csv'
@@ -13,3 +17,23 @@ def global_join_filename(base_dir):
 
 def global_nuclei_filename(base_dir):
     return os.path.join(base_dir, 'nuclei.json')
+
+def global_nuclei_info_filename(base_dir):
+    return os.path.join(base_dir, 'nuclei_info.csv')
+
+def segments_dirname(base_dir):
+    return os.path.join(base_dir, 'fish_join_segments')
+
+def segment_prefix(base_dir, image_path):
+    # Mirror the image's absolute path under the segments dir, so segments of different images never collide
+    image_path = os.path.splitdrive(os.path.abspath(image_path))[1].lstrip(os.path.sep)
+    return os.path.join(segments_dirname(base_dir), image_path)
+
+def segment_join_filename(base_dir, image_path):
+    return segment_prefix(base_dir, image_path) + SEGMENT_JOIN_SUFFIX
+
+def segment_nuclei_filename(base_dir, image_path):
+    return segment_prefix(base_dir, image_path) + SEGMENT_NUCLEI_SUFFIX
+
+def segment_nuclei_info_filename(base_dir, image_path):
+    return segment_prefix(base_dir, image_path) + SEGMENT_NUCLEI_INFO_SUFFIX
@@ -1,14 +1,20 @@
 import static qupath.lib.gui.scripting.QPEx.*
 import org.json.JSONObject
 
-if (args.size() > 1) {
+if (args.size() > 2) {
     global_qupath_params_json = args[0]
     per_file_params_json = args[1]
+    output_filenames_json = args[2]
+} else if (args.size() > 1) {
+    global_qupath_params_json = args[0]
+    per_file_params_json = args[1]
+    output_filenames_json = "{}"
 } else if (args.size() == 1) {
     global_qupath_params_json = args[0]
     per_file_params_json = "{}"
+    output_filenames_json = "{}"
 } else {
-    println("Expected args: JSON_OF_PARAMS [JSON_OF_PER_FILE_PARAMS]")
+    println("Expected args: JSON_OF_PARAMS [JSON_OF_PER_FILE_PARAMS [JSON_OF_OUTPUT_FILENAMES]]")
     return
 }
 
@@ -22,9 +28,18 @@ def jsonObjectToMap(JSONObject jsonObject) {
 
 def per_file_params = jsonObjectToMap(new JSONObject(per_file_params_json))
 def global_qupath_params = jsonObjectToMap(new JSONObject(global_qupath_params_json))
+def output_filenames = jsonObjectToMap(new JSONObject(output_filenames_json))
 
-def imgPath = getCurrentImageData().getServer().getURIs()[0].getPath()
+def imgUri = getCurrentImageData().getServer().getURIs()[0]
+def imgPath = imgUri.getPath()
 def targetGeo = imgPath.take(imgPath.lastIndexOf('.')) + '_nuclei.geojson'
+if (output_filenames) {
+    // Keys are normalized absolute paths, see QuPathSegmentor.process_file_list()
+    def normalizedImgPath = java.nio.file.Paths.get(imgUri).toAbsolutePath().normalize().toString()
+    if (!output_filenames.containsKey(normalizedImgPath))
+        throw new IllegalArgumentException("No output filename given for image ${imgPath}, refusing to write next to it")
+    targetGeo = output_filenames.get(normalizedImgPath)
+}
 setImageType('FLUORESCENCE');
 createFullImageAnnotation(true)
 def param_overrides = jsonObjectToMap(per_file_params.get(imgPath, new JSONObject("{}")))
@@ -0,0 +1,121 @@
+import csv
+import os
+
+from fish_join_modules.atomic import atomic_write
+from fish_join_modules.join import GLOBAL_JOIN_HEADERS
+from fish_join_modules.nuclei_info import NUCLEI_INFO_HEADERS
+from fish_join_modules.output_filenames import global_join_filename, global_nuclei_filename, \
+        global_nuclei_info_filename, segments_dirname, segment_prefix, SEGMENT_JOIN_SUFFIX, \
+        SEGMENT_NUCLEI_SUFFIX, SEGMENT_NUCLEI_INFO_SUFFIX
+
+
+def list_segments(base_dir, image_paths=None):
+    """
+    Return the path prefixes of complete image segments under base_dir. A segment is
+    complete once its join file exists, as it is written after the nuclei files.
+
+    :param str base_dir: Output directory of the batch run(s)
+    :param list image_paths: Only list the segments of these images, in this order. If None,
+                             list all segments under base_dir, sorted.
+    """
+    if image_paths is not None:
+        prefixes = [ segment_prefix(base_dir, p) for p in image_paths ]
+        return [ p for p in prefixes if os.path.exists(p + SEGMENT_JOIN_SUFFIX) ]
+
+    prefixes = []
+    for path, dirnames, filenames in os.walk(segments_dirname(base_dir)):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if filename.endswith(SEGMENT_JOIN_SUFFIX):
+                prefixes.append(os.path.join(path, filename[:-len(SEGMENT_JOIN_SUFFIX)]))
+
+    return prefixes
+
+def remove_segment(base_dir, image_path):
+    """
+    Remove an image's segment files. The join file goes first, so the segment is never
+    considered complete while the rest is being removed.
+    """
+    _remove_segment_files(segment_prefix(base_dir, image_path))
+
+def _remove_segment_files(prefix):
+    for suffix in [SEGMENT_JOIN_SUFFIX, SEGMENT_NUCLEI_SUFFIX, SEGMENT_NUCLEI_INFO_SUFFIX]:
+        try:
+            os.remove(prefix + suffix)
+        except OSError:
+            # Already gone, e.g. never written or removed by another process
+            if os.path.exists(prefix + suffix):
+                raise
+
+def prune_segments(base_dir, images_dir, image_paths):
+    """
+    Remove the segments of images under images_dir that aren't in image_paths, e.g. images
+    that were removed or moved, or no longer match the run's pattern. Segments of images
+    outside images_dir, e.g. from runs on other directories, are kept.
+
+    :param str base_dir: Output directory of the batch run(s)
+    :param str images_dir: Images directory of the run
+    :param list image_paths: Images of the run
+    :return int: Number of removed segments
+    """
+    keep = set(segment_prefix(base_dir, p) for p in image_paths)
+    stale = set()
+    for path, _, filenames in os.walk(segment_prefix(base_dir, images_dir)):
+        for filename in filenames:
+            for suffix in [SEGMENT_JOIN_SUFFIX, SEGMENT_NUCLEI_SUFFIX, SEGMENT_NUCLEI_INFO_SUFFIX]:
+                if filename.endswith(suffix):
+                    prefix = os.path.join(path, filename[:-len(suffix)])
+                    if prefix not in keep:
+                        stale.add(prefix)
+                    break
+    for prefix in sorted(stale):
+        _remove_segment_files(prefix)
+
+    return len(stale)
+
+def merge_segments(base_dir, image_paths=None):
+    """
+    Build the global join CSV, nuclei json and nuclei info CSV of base_dir from its image
+    segments, in a single sequential pass over each segment file. Can be run again at any
+    time, e.g. after other processes added segments to the same base directory.
+
+    Merging all segments includes every run that used base_dir. Segments of images that were
+    removed or moved are kept until prune_segments() runs on their images directory, or until
+    the segments directory (see segments_dirname()) is deleted.
+
+    :param str base_dir: Output directory of the batch run(s)
+    :param list image_paths: Only merge the segments of these images. If None, merge all segments.
+    :return int: Number of merged image segments
+    """
+    prefixes = list_segments(base_dir, image_paths)
+    with atomic_write(global_join_filename(base_dir), 'wb') as global_join:
+        _concat_csv([p + SEGMENT_JOIN_SUFFIX for p in prefixes], global_join, GLOBAL_JOIN_HEADERS)
+    with atomic_write(global_nuclei_filename(base_dir)) as global_nuclei:
+        global_nuclei.write('[\n')
+        is_first = True
+        for p in prefixes:
+            for line in open(p + SEGMENT_NUCLEI_SUFFIX):
+                line = line.rstrip('\r\n')
+                if not line:
+                    continue
+                if not is_first:
+                    global_nuclei.write(',\n')
+                global_nuclei.write(line)
+                is_first = False
+        global_nuclei.write('\n]\n')
+    # Written after the nuclei json, as an older info file is considered stale (see Show nuclei info)
+    with atomic_write(global_nuclei_info_filename(base_dir), 'wb') as global_nuclei_info:
+        _concat_csv([p + SEGMENT_NUCLEI_INFO_SUFFIX for p in prefixes], global_nuclei_info, NUCLEI_INFO_HEADERS)
+
+    return len(prefixes)
+
+def _concat_csv(paths, output, headers):
+    """
+    Concatenate CSV files that have the given headers, writing the header line only once
+    """
+    csv.writer(output).writerow(headers)
+    for path in paths:
+        with open(path, 'rb') as segment:
+            segment.readline()
+            for chunk in iter(lambda: segment.read(1024 * 1024), ''):
+                output.write(chunk)